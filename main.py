@@ -5,59 +5,80 @@ from fastapi.responses import FileResponse, JSONResponse
 from starlette.websockets import WebSocketDisconnect
 from pydantic import BaseModel
 import uvicorn
+import importlib.util
 import os
 import time
 import shutil
-from typing import Optional, List
+import tempfile
+from typing import Optional, List, Dict
 import logging
 import sys
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from voice_service import VoiceService
 import base64
 import json
 import numpy as np
 import asyncio  # 添加这个导入
 
-# 创建logs目录
-os.makedirs('logs', exist_ok=True)
-
-# 获取当前时间戳作为日志文件名
-log_filename = time.strftime('app_%Y%m%d_%H%M%S.log')
-log_filepath = os.path.join('logs', log_filename)
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # 配置日志格式
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-# 创建文件处理器
-file_handler = RotatingFileHandler(
-    log_filepath,  # 使用带时间戳的文件名
-    maxBytes=1024*1024,  # 1MB
-    backupCount=5,
-    encoding='utf-8'
-)
-file_handler.setFormatter(formatter)
-file_handler.setLevel(logging.INFO)
-
-# 创建控制台处理器
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(formatter)
-console_handler.setLevel(logging.INFO)
+# 日志先写入队列，由后台线程统一写文件和控制台，避免在请求路径上阻塞磁盘 I/O
+log_queue = queue.Queue(-1)
+queue_handler = QueueHandler(log_queue)
+log_listener: Optional[QueueListener] = None
 
 # 配置根日志记录器
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+logger.addHandler(queue_handler)
 
 # 确保不会重复添加处理器
 logger.propagate = False
 
 # 配置 uvicorn 访问日志
-logging.getLogger("uvicorn.access").handlers = [file_handler, console_handler]
-logging.getLogger("uvicorn.error").handlers = [file_handler, console_handler]
+logging.getLogger("uvicorn.access").handlers = [queue_handler]
+logging.getLogger("uvicorn.error").handlers = [queue_handler]
+
+def start_logging() -> None:
+    """
+    创建日志文件并启动后台日志线程。
+    在服务启动时调用：并行识别的 spawn 子进程会重新导入本模块，不应再各自创建日志文件和监听线程
+    """
+    global log_listener
+    # 创建logs目录
+    os.makedirs('logs', exist_ok=True)
+
+    # 获取当前时间戳作为日志文件名
+    log_filename = time.strftime('app_%Y%m%d_%H%M%S.log')
+    log_filepath = os.path.join('logs', log_filename)
+
+    # 创建文件处理器
+    file_handler = RotatingFileHandler(
+        log_filepath,  # 使用带时间戳的文件名
+        maxBytes=1024*1024,  # 1MB
+        backupCount=5,
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(formatter)
+    file_handler.setLevel(logging.INFO)
 
-# 记录服务启动信息
-logger.info(f"服务启动，日志文件: {log_filepath}")
+    # 创建控制台处理器
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(formatter)
+    console_handler.setLevel(logging.INFO)
+
+    log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    log_listener.start()
+
+    # 记录服务启动信息
+    logger.info(f"服务启动，日志文件: {log_filepath}")
 
 # 强制刷新输出
 sys.stdout.reconfigure(line_buffering=True)
@@ -79,17 +100,53 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# 配置CORS
+# 配置CORS：通过 CORS_ORIGINS（逗号分隔）指定允许的来源；
+# 通配符 * 与 allow_credentials 同时使用会被浏览器忽略，因此只在指定来源时允许凭据
+CORS_ORIGINS = [o.strip() for o in os.environ.get("CORS_ORIGINS", "*").split(",") if o.strip()]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=CORS_ORIGINS,
+    allow_credentials="*" not in CORS_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
-# 创建语音服务实例
-voice_service = VoiceService()
+# 语音服务实例在启动事件中创建，见 startup_event
+voice_service: Optional[VoiceService] = None
+
+# 每个模型同时只运行一个推理任务，避免多个 whisper 进程互相抢占 CPU
+DEFAULT_MODEL = "ggml-tiny.bin"
+model_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+async def run_inference(model_name: str, func, *args):
+    """
+    在线程池中执行阻塞的识别调用，避免阻塞事件循环
+    model_name 需由调用方校验为已存在的模型，每个模型名会保留一个信号量
+    """
+    semaphore = model_semaphores.setdefault(model_name, asyncio.Semaphore(1))
+    async with semaphore:
+        return await asyncio.to_thread(func, *args)
+
+def collect_sentences(func, *args) -> List[str]:
+    """
+    在工作线程中消费识别返回的句子迭代器，避免在事件循环中读取子进程输出
+    """
+    return list(func(*args))
+
+# WebSocket 音频缓冲区按此最大采样率预分配
+MAX_SAMPLE_RATE = 48000
+
+# 保存上传文件时的拷贝缓冲区大小，减少 read/write 系统调用次数
+UPLOAD_COPY_BUFSIZE = 1024 * 1024
+
+async def send_obj(websocket: WebSocket, obj: dict) -> None:
+    """
+    发送 JSON 消息；已安装 orjson 时用它序列化，仍以文本帧发送以兼容前端
+    """
+    if orjson is not None:
+        await websocket.send_text(orjson.dumps(obj).decode("utf-8"))
+    else:
+        await websocket.send_json(obj)
 
 # 响应模型
 class RecognitionResponse(BaseModel):
@@ -108,16 +165,21 @@ async def read_root():
 @app.post("/api/recognize", response_model=RecognitionResponse)
 async def recognize_audio(
     file: UploadFile = File(...),
-    model: Optional[str] = "ggml-tiny.bin"
+    model: Optional[str] = DEFAULT_MODEL
 ):
+    # 先校验模型名：run_inference 按模型名创建信号量，不能让任意名称留在字典里
+    if not model or not voice_service.check_model_exists(model):
+        raise HTTPException(status_code=400, detail=f"模型不存在: {model}")
+    
+    temp_file = None
     try:
-        # 生成临时文件
-        temp_file = os.path.join(voice_service._output_dir, f"temp_{int(time.time())}.raw")
-        
-        # 保存上传的文件
+        # 保存上传的文件（唯一文件名，避免并发请求互相覆盖）
         try:
-            with open(temp_file, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            with tempfile.NamedTemporaryFile(
+                dir=voice_service._output_dir, prefix="temp_", suffix=".raw", delete=False
+            ) as buffer:
+                temp_file = buffer.name
+                shutil.copyfileobj(file.file, buffer, length=UPLOAD_COPY_BUFSIZE)
             logger.info(f"Saved uploaded file to {temp_file}")
         except Exception as e:
             logger.error(f"Error saving uploaded file: {e}")
@@ -126,10 +188,13 @@ async def recognize_audio(
         try:
             # 处理音频
             start_time = time.time()
-            result = voice_service.process_stream(temp_file, model)
+            sentences = await run_inference(
+                model, collect_sentences, voice_service.process_stream, temp_file, model
+            )
+            result = " ".join(sentences)
             duration = time.time() - start_time
             
-            if not result or not result.strip():
+            if not result:
                 logger.warning("No text detected in audio")
                 return RecognitionResponse(
                     text="",
@@ -155,8 +220,10 @@ async def recognize_audio(
     finally:
         # 清理临时文件
         try:
-            if os.path.exists(temp_file):
+            if temp_file:
                 os.remove(temp_file)
+        except FileNotFoundError:
+            pass
         except Exception as e:
             logger.error(f"Error cleaning up temp file {temp_file}: {e}")
 
@@ -166,7 +233,8 @@ async def listen():
     直接录音并识别
     """
     try:
-        result, duration = voice_service.listen()
+        # 录音可能无限等待，不能占用推理信号量；识别步骤在 VoiceService 内部串行
+        result, duration = await asyncio.to_thread(voice_service.listen)
         return RecognitionResponse(
             text=result,
             duration=duration,
@@ -194,65 +262,112 @@ async def websocket_endpoint(websocket: WebSocket):
     # 用于控制任务的事件
     shutdown_event = asyncio.Event()
     
-    # 用于累积音频数据
-    audio_buffer = []
-    buffer_duration = 0  # 累积的音频时长（秒）
+    # 用于累积音频数据：预分配连续缓冲区，按写指针追加，避免每次 concatenate
     MIN_DURATION = 2.0   # 增加到2秒
+    audio_buffer = np.empty(int(MAX_SAMPLE_RATE * MIN_DURATION * 2), dtype=np.int16)
+    write_idx = 0        # 已写入的样本数
     
     async def process_audio():
         try:
-            nonlocal audio_buffer, buffer_duration
+            nonlocal audio_buffer, write_idx
+            
+            # 连接建立后先接收一次会话参数，之后每帧都是不带头部的 int16 PCM
+            try:
+                hello = await websocket.receive_json()
+            except WebSocketDisconnect:
+                logger.info("WebSocket disconnected before hello message")
+                return
+            if not isinstance(hello, dict):
+                await send_obj(websocket, {
+                    "status": "error",
+                    "text": "会话参数格式错误，应为 JSON 对象"
+                })
+                return
+            sample_rate = hello.get("sample_rate", 16000)
+            channels = hello.get("channels", 1)
+            # bool 是 int 的子类，需要单独排除
+            if not isinstance(sample_rate, int) or isinstance(sample_rate, bool) or sample_rate <= 0:
+                await send_obj(websocket, {
+                    "status": "error",
+                    "text": f"采样率无效: {sample_rate}"
+                })
+                return
+            if not isinstance(channels, int) or isinstance(channels, bool):
+                await send_obj(websocket, {
+                    "status": "error",
+                    "text": f"声道数无效: {channels}"
+                })
+                return
+            logger.info(f"会话参数: 采样率={sample_rate}Hz, 声道数={channels}")
+            
+            if channels != 1:
+                await send_obj(websocket, {
+                    "status": "error",
+                    "text": f"仅支持单声道音频，当前声道数: {channels}"
+                })
+                return
             
             while True:  # 移除 shutdown_event 检查
                 try:
-                    data = await websocket.receive_bytes()
-                    header = np.frombuffer(data[:8], dtype=np.int32)
-                    sample_rate, num_samples = header
-                    audio_data = np.frombuffer(data[8:], dtype=np.int16)
-                    volume = np.abs(audio_data).mean()
+                    audio_data = np.frombuffer(await websocket.receive_bytes(), dtype=np.int16)
+                    num_samples = audio_data.size
+                    # int32 取绝对值，避免 int16 的 -32768 溢出
+                    volume = np.abs(audio_data, dtype=np.int32).mean()
                     
-                    logger.info(f"音频信息: 采样率={sample_rate}Hz, 样本数={num_samples}, 平均音量={volume:.2f}")
+                    # 每帧日志只在 DEBUG 级别输出，避免热路径上的格式化和写入
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"音频信息: 采样率={sample_rate}Hz, 样本数={num_samples}, 平均音量={volume:.2f}")
                     
                     # 音量太小则跳过
                     if volume < 500:  # 调整音量阈值
                         continue
                         
                     # 累积音频数据
-                    audio_buffer.append(audio_data)
-                    buffer_duration += num_samples / sample_rate
+                    n = audio_data.size
+                    if write_idx + n > audio_buffer.size:
+                        # 单帧异常大时扩容，保持缓冲区连续
+                        grown = np.empty(max(audio_buffer.size * 2, write_idx + n), dtype=np.int16)
+                        grown[:write_idx] = audio_buffer[:write_idx]
+                        audio_buffer = grown
+                    audio_buffer[write_idx:write_idx + n] = audio_data
+                    write_idx += n
+                    buffer_duration = write_idx / sample_rate
                     
                     # 达到最小时长则处理
                     if buffer_duration >= MIN_DURATION:
-                        # 合并音频数据
-                        combined_audio = np.concatenate(audio_buffer)
+                        # 缓冲区已写部分的视图（零拷贝）
+                        combined_audio = audio_buffer[:write_idx]
                         logger.info(f"合并音频数据: {len(combined_audio)} 样本")
                         
-                        # 计算音量统计
-                        mean_volume = np.abs(combined_audio).mean()
-                        max_volume = np.abs(combined_audio).max()
+                        # 计算音量统计（取一次绝对值，均值和最大值共用）
+                        abs_audio = np.abs(combined_audio, dtype=np.int32)
+                        mean_volume = abs_audio.mean()
+                        max_volume = abs_audio.max()
                         logger.info(f"音频统计: 平均音量={mean_volume:.2f}, 最大音量={max_volume:.2f}")
                         
-                        # 保存为临时文件
-                        temp_file = os.path.join(voice_service._output_dir, f"temp_{int(time.time())}.raw")
-                        combined_audio.tofile(temp_file)
-                        logger.info(f"保存累积音频数据: {temp_file}, 时长: {buffer_duration:.2f}秒")
+                        logger.info(f"累积音频时长: {buffer_duration:.2f}秒")
                         
                         try:
-                            # 处理音频
-                            result = voice_service.process_stream(temp_file)
+                            # 处理音频（内存中直接识别，不写临时文件）
+                            result = await run_inference(
+                                DEFAULT_MODEL,
+                                collect_sentences,
+                                voice_service.process_stream_array,
+                                combined_audio,
+                                sample_rate
+                            )
                             logger.info(f"处理结果: {result}")
                             
-                            # 无论是否有识别结果都发送消息
-                            if result:
-                                for sentence in result:
-                                    if sentence:
-                                        await websocket.send_json({
-                                            "status": "success",
-                                            "text": sentence
-                                        })
+                            # 无论是否有识别结果都发送消息，多个句子合并为一条消息
+                            sentences = [s for s in result if s]
+                            if sentences:
+                                await send_obj(websocket, {
+                                    "status": "success",
+                                    "sentences": sentences
+                                })
                             else:
                                 # 发送空结果消息
-                                await websocket.send_json({
+                                await send_obj(websocket, {
                                     "status": "no_text",
                                     "text": "未识别到文本"
                                 })
@@ -261,19 +376,13 @@ async def websocket_endpoint(websocket: WebSocket):
                         except Exception as e:
                             logger.error(f"音频处理错误: {e}")
                             # 发送错误消息
-                            await websocket.send_json({
+                            await send_obj(websocket, {
                                 "status": "error",
                                 "text": f"处理错误: {str(e)}"
                             })
-                        finally:
-                            # 清理临时文件
-                            if os.path.exists(temp_file):
-                                os.remove(temp_file)
-                                logger.info(f"Cleaned up {temp_file}")
                             
-                        # 重置缓冲区
-                        audio_buffer = []
-                        buffer_duration = 0
+                        # 重置写指针
+                        write_idx = 0
                         
                 except WebSocketDisconnect:
                     logger.info("WebSocket disconnected in audio processing")
@@ -299,10 +408,23 @@ async def websocket_endpoint(websocket: WebSocket):
             logger.error(f"关闭WebSocket连接出错: {e}")
 
 # 添加优雅关闭处理
+@app.on_event("startup")
+async def startup_event():
+    global voice_service
+    start_logging()
+    # 在启动事件而非模块导入时创建语音服务：并行识别的 spawn 子进程会重新导入本模块，
+    # 放在模块级会让每个工作进程都加载常驻模型、启动服务端进程
+    voice_service = VoiceService()
+
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("Application shutting down")
     # 这里可以添加其他清理代码
+    if voice_service is not None:
+        voice_service.shutdown()
+    # 停止日志监听线程，写完队列中剩余的日志
+    if log_listener is not None:
+        log_listener.stop()
 
 # 挂载静态文件
 # 注意：这里要把静态文件路由放在最后，避免覆盖API路由
@@ -310,10 +432,15 @@ app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 app.mount("/", StaticFiles(directory=FRONTEND_DIR, html=True), name="frontend")
 
 if __name__ == "__main__":
+    # 已安装 uvloop 时使用更快的事件循环；音频帧无法压缩，关闭 permessage-deflate
     uvicorn.run(
-        "main:app",
+        app,  # 直接传入应用对象，避免以 main 模块名再次导入本文件
         host="0.0.0.0",
         port=8000,
-        reload=True,
-        access_log=True
+        reload=False,   # 文件监视会重复导入模块，生产环境关闭
+        workers=1,      # 多进程会重复加载模型，并发由线程池处理
+        loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        ws="websockets" if importlib.util.find_spec("websockets") else "auto",
+        ws_per_message_deflate=False,
+        access_log=False
     )
\ No newline at end of file
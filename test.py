@@ -1,12 +1,19 @@
 import subprocess
 import threading
 import queue
-import time
+import math
 import pyaudio
 import wave
 import numpy as np
+from scipy.signal import resample_poly
 from typing import Optional
 
+try:
+    # whisper.cpp 的 Python 绑定，可常驻加载模型
+    from pywhispercpp.model import Model as WhisperModel
+except ImportError:
+    WhisperModel = None
+
 class WhisperStream:
     def __init__(self, 
                  model_path: str,
@@ -15,7 +22,8 @@ class WhisperStream:
                  chunk_size: int = 1024,
                  channels: int = 1,
                  input_device_index: Optional[int] = None,
-                 language: str = "en"):
+                 language: str = "en",
+                 pa: Optional[pyaudio.PyAudio] = None):
         self.model_path = model_path
         self.whisper_cpp_path = whisper_cpp_path
         self.sample_rate = sample_rate
@@ -23,17 +31,34 @@ class WhisperStream:
         self.channels = channels
         self.input_device_index = input_device_index
         self.language = language
-        self.resample_ratio = sample_rate / 16000  # whisper需要16kHz
+        # whisper需要16kHz，预先计算多相重采样的升/降采样因子
+        g = math.gcd(sample_rate, 16000)
+        self.resample_up = 16000 // g
+        self.resample_down = sample_rate // g
         
         self.audio_queue = queue.Queue()
         self.is_recording = False
         self.stream: Optional[pyaudio.Stream] = None
-        self.p: Optional[pyaudio.PyAudio] = None
+        # 可复用外部已初始化的 PyAudio 实例，避免重复初始化 PortAudio
+        self.p: Optional[pyaudio.PyAudio] = pa
+        
+        # 模型只加载一次，之后每段音频只做推理；未安装绑定时回退到命令行
+        self.model = None
+        if WhisperModel is not None:
+            self.model = WhisperModel(
+                model_path,
+                n_threads=8,
+                language=language,
+                print_progress=False,
+                print_realtime=False,
+            )
         
     @staticmethod
-    def list_audio_devices():
-        """列出所有可用的音频输入设备"""
-        p = pyaudio.PyAudio()
+    def list_audio_devices(p: Optional[pyaudio.PyAudio] = None):
+        """列出所有可用的音频输入设备，传入 p 时复用该 PyAudio 实例"""
+        owns_p = p is None
+        if owns_p:
+            p = pyaudio.PyAudio()
         devices = []
         
         print("\n可用的音频输入设备:")
@@ -52,13 +77,15 @@ class WhisperStream:
         except Exception as e:
             print(f"警告：枚举设备时出错: {e}")
         
-        p.terminate()
+        if owns_p:
+            p.terminate()
         return devices
         
     def start_recording(self):
         """开始录音并将音频数据放入队列"""
         self.is_recording = True
-        self.p = pyaudio.PyAudio()
+        if self.p is None:
+            self.p = pyaudio.PyAudio()
         
         def audio_callback(in_data, frame_count, time_info, status):
             self.audio_queue.put(in_data)
@@ -68,7 +95,7 @@ class WhisperStream:
             # 优先使用pulse设备
             try:
                 self.stream = self.p.open(
-                    format=pyaudio.paFloat32,
+                    format=pyaudio.paInt16,
                     channels=self.channels,
                     rate=self.sample_rate,
                     input=True,
@@ -86,7 +113,7 @@ class WhisperStream:
             # 如果指定设备失败，尝试使用默认设备
             try:
                 self.stream = self.p.open(
-                    format=pyaudio.paFloat32,
+                    format=pyaudio.paInt16,
                     channels=self.channels,
                     rate=self.sample_rate,
                     input=True,
@@ -122,28 +149,31 @@ class WhisperStream:
         last_db = -100
         
         while self.is_recording:
-            # 收集音频数据（8秒）
-            audio_data = b''
+            # 收集音频数据（8秒），阻塞等待队列而不是轮询
+            chunks = []
             chunks_to_collect = int(self.sample_rate * 8 / self.chunk_size)
             
             for _ in range(chunks_to_collect):
-                if not self.audio_queue.empty():
-                    chunk = self.audio_queue.get()
-                    audio_data += chunk
-                else:
-                    time.sleep(0.1)
+                if not self.is_recording:
+                    break
+                try:
+                    chunks.append(self.audio_queue.get(timeout=0.5))
+                except queue.Empty:
                     continue
+            audio_data = b''.join(chunks)
             
             if not audio_data:
                 continue
                 
             try:
                 # 转换为numpy数组进行处理
-                audio_array = np.frombuffer(audio_data, dtype=np.float32)
+                audio_array = np.frombuffer(audio_data, dtype=np.int16)
                 
-                # 计算分贝值
-                rms = np.sqrt(np.mean(np.square(audio_array)))
-                db = 20 * np.log10(rms) if rms > 0 else -100
+                # 计算分贝值（以 int16 满幅为参考）；einsum 在 int64 中累加平方和，
+                # 按块转换类型，不会生成整段数组的宽类型副本
+                square_sum = int(np.einsum('i,i->', audio_array, audio_array, dtype=np.int64))
+                rms = math.sqrt(square_sum / audio_array.size)
+                db = 20 * math.log10(rms / 32768) if rms > 0 else -100
                 
                 # 只在音量显著变化时更新显示
                 if abs(db - last_db) > 3:
@@ -155,50 +185,21 @@ class WhisperStream:
                 if db < -50:  # 调整静音阈值
                     continue
                 
-                # 音频预处理
-                # 1. 去除直流偏置
-                audio_array = audio_array - np.mean(audio_array)
-                
-                # 2. 归一化到 [-1, 1]
-                max_amp = np.max(np.abs(audio_array))
-                if max_amp > 0:
-                    audio_array = audio_array / max_amp * 0.9
-                
-                # 3. 重采样到16kHz (whisper要求)
-                resampled = audio_array[::int(self.resample_ratio)]
-                
-                # 4. 转换到16位整数格式 (-32768 到 32767)
-                int16_data = (resampled * 32767).astype(np.int16)
-                
-                # 保存为16位WAV文件
-                with wave.open(temp_wav, 'wb') as wf:
-                    wf.setnchannels(self.channels)
-                    wf.setsampwidth(2)  # 16-bit = 2 bytes
-                    wf.setframerate(16000)  # Whisper需要16kHz
-                    wf.writeframes(int16_data.tobytes())
+                # 多相滤波重采样到16kHz (whisper要求)，归一化交给 whisper.cpp
+                resampled = resample_poly(audio_array, self.resample_up, self.resample_down)
+                resampled = np.clip(resampled, -32768, 32767).astype(np.int16)
                 
                 print("\n正在识别...")
                 
-                # 调用whisper.cpp进行识别
-                cmd = [
-                    self.whisper_cpp_path,
-                    "-m", self.model_path,
-                    "-f", temp_wav,
-                    "--no-timestamps",
-                    "--print-special",
-                    "--language", self.language,
-                    "-t", "8",        # 8线程
-                    "-p", "1",        # 1个处理器
-                ]
-                
-                result = subprocess.run(cmd, 
-                                     capture_output=True, 
-                                     text=True,
-                                     encoding='utf-8',
-                                     check=True)
+                if self.model is not None:
+                    # 常驻模型直接识别内存中的音频
+                    segments = self.model.transcribe(resampled.astype(np.float32) / 32768.0)
+                    text = " ".join(seg.text.strip() for seg in segments).strip()
+                else:
+                    text = self._transcribe_with_cli(resampled, temp_wav)
                 
-                if result.stdout.strip():
-                    print(f"[识别结果] >>> {result.stdout.strip()}")
+                if text:
+                    print(f"[识别结果] >>> {text}")
                     print("-" * 50)
                     print("请继续说话...")
                 
@@ -208,8 +209,34 @@ class WhisperStream:
             except Exception as e:
                 print(f"\n处理错误: {e}")
                 
-            time.sleep(0.1)  # 短暂暂停
-                
+    def _transcribe_with_cli(self, int16_data: np.ndarray, temp_wav: str) -> str:
+        """未安装 pywhispercpp 时，写 WAV 并调用 whisper.cpp 命令行识别"""
+        # 保存为16位WAV文件
+        with wave.open(temp_wav, 'wb') as wf:
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(2)  # 16-bit = 2 bytes
+            wf.setframerate(16000)  # Whisper需要16kHz
+            wf.writeframes(memoryview(int16_data).cast("B"))  # 直接传缓冲区，避免 tobytes 拷贝
+        
+        # 调用whisper.cpp进行识别
+        cmd = [
+            self.whisper_cpp_path,
+            "-m", self.model_path,
+            "-f", temp_wav,
+            "--no-timestamps",
+            "--print-special",
+            "--language", self.language,
+            "-t", "8",        # 8线程
+            "-p", "1",        # 1个处理器
+        ]
+        
+        result = subprocess.run(cmd, 
+                             capture_output=True, 
+                             text=True,
+                             encoding='utf-8',
+                             check=True)
+        return result.stdout.strip()
+            
     def run(self):
         """启动流式识别"""
         try:
@@ -225,8 +252,11 @@ class WhisperStream:
             self.stop_recording()
 
 if __name__ == "__main__":
+    # 整个程序共用一个 PyAudio 实例，PortAudio 只初始化一次
+    pa = pyaudio.PyAudio()
+    
     # 首先列出所有可用的音频设备
-    available_devices = WhisperStream.list_audio_devices()
+    available_devices = WhisperStream.list_audio_devices(pa)
     
     if not available_devices:
         print("未找到可用的音频输入设备！")
@@ -234,6 +264,7 @@ if __name__ == "__main__":
         print("1. 确保 Windows 系统中有可用的麦克风")
         print("2. 检查 Windows 的隐私设置，确保允许应用访问麦克风")
         print("3. 在 Windows 中测试麦克风是否正常工作")
+        pa.terminate()
         exit(1)
     
     # 让用户选择输入设备
@@ -257,7 +288,8 @@ if __name__ == "__main__":
         model_path="/home/huiyu/whisper.cpp/models/ggml-tiny.bin",
         whisper_cpp_path="/home/huiyu/whisper.cpp/main",
         input_device_index=device_index,
-        language="en"  # 设置为英语
+        language="en",  # 设置为英语
+        pa=pa
     )
     
     try:
@@ -14,6 +14,21 @@ class MicrophoneTester:
         self.device_index = device_index
         self.p = None
         self.stream = None
+        self.latest_volume = 0.0  # 回调线程写入的最新音量，由主线程负责显示
+        
+    def _print_level(self):
+        """打印当前音量条（在主线程中调用，不占用音频回调线程）"""
+        volume_norm = self.latest_volume
+        # 计算分贝值 (参考值为1.0)
+        db = 20 * np.log10(volume_norm) if volume_norm > 0 else -100
+        
+        # 创建音量条
+        bar_length = 50
+        bar_count = int((volume_norm * 1000) * bar_length)
+        bar_count = min(bar_count, bar_length)
+        
+        # 清除当前行并打印音量条
+        print(f'\r音量: {"█" * bar_count + "░" * (bar_length - bar_count)} {db:.1f} dB   ', end='')
         
     def list_devices(self):
         """列出所有可用的音频输入设备"""
@@ -37,18 +52,8 @@ class MicrophoneTester:
         def callback(in_data, frame_count, time_info, status):
             # 将音频数据转换为numpy数组
             audio_data = np.frombuffer(in_data, dtype=np.float32)
-            # 计算音量
-            volume_norm = np.linalg.norm(audio_data) / len(audio_data)
-            # 计算分贝值 (参考值为1.0)
-            db = 20 * np.log10(volume_norm) if volume_norm > 0 else -100
-            
-            # 创建音量条
-            bar_length = 50
-            bar_count = int((volume_norm * 1000) * bar_length)
-            bar_count = min(bar_count, bar_length)
-            
-            # 清除当前行并打印音量条
-            print(f'\r音量: {"█" * bar_count + "░" * (bar_length - bar_count)} {db:.1f} dB   ', end='')
+            # 计算音量，只记录数值，格式化和输出交给主线程，避免回调阻塞导致丢帧
+            self.latest_volume = np.linalg.norm(audio_data) / len(audio_data)
             
             return (in_data, pyaudio.paContinue)
         
@@ -68,13 +73,13 @@ class MicrophoneTester:
             print("请对着麦克风说话，音量条会实时显示声音大小")
             print("按 Ctrl+C 停止监测\n")
             
-            # 如果设置了持续时间，就等待指定时间
-            if duration:
-                time.sleep(duration)
-            else:
-                # 否则一直运行直到被中断
-                while self.stream.is_active():
-                    time.sleep(0.1)
+            # 以约 30Hz 刷新音量显示；设置了持续时间则到时停止，否则一直运行直到被中断
+            deadline = time.monotonic() + duration if duration else None
+            while self.stream.is_active():
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                self._print_level()
+                time.sleep(1 / 30)
                     
         except KeyboardInterrupt:
             print("\n\n停止监测")
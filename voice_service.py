@@ -2,20 +2,318 @@ import os
 import subprocess
 import time
 import wave
+import struct
+import functools
+import json
+import socket
+import uuid
+import http.client
 import speech_recognition as sr
-from typing import Optional, Tuple, Dict
+from typing import Optional, Tuple, Dict, Union, Iterator, Set
 import logging
 import re
+import numpy as np
+import ctypes
+import ctypes.util
+import sys
+import hashlib
+import sqlite3
+import threading
+import multiprocessing
+import queue
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    # whisper.cpp 的 Python 绑定，模型可常驻内存
+    from pywhispercpp.model import Model as WhisperModel
+except ImportError:
+    WhisperModel = None
+
+try:
+    # CTranslate2 版 whisper，有 CUDA 时用于 GPU 推理
+    import ctranslate2
+    from faster_whisper import WhisperModel as FasterWhisperModel
+except ImportError:
+    FasterWhisperModel = None
 
 # 获取记录器
 logger = logging.getLogger(__name__)  # 使用 __name__ 而不是创建新的基础配置
 
+try:
+    # google-re2：线性时间的 DFA 正则引擎，接口与 re 兼容
+    import re2 as _regex
+except ImportError:
+    _regex = re
+
+# whisper 输出清理用的正则，模块加载时编译一次
+_MARKUP_RE = _regex.compile(r'\x1b\[[0-9;]*[a-zA-Z]|\[[^\]\n]*\]')  # ANSI 转义序列和 [xxx] 特殊标记
+_SENTENCE_RE = _regex.compile(r'[^.。!！?？]+')  # 句号、问号、感叹号之间的文本
+
+# 并行识别时每个工作进程持有的模型，由进程池 initializer 加载一次
+_worker_model = None
+
+def _init_parallel_worker(model_path: str, n_threads: int) -> None:
+    global _worker_model
+    _worker_model = WhisperModel(
+        model_path,
+        n_threads=n_threads,
+        print_progress=False,
+        print_realtime=False,
+    )
+
+def _transcribe_chunk(pcm: np.ndarray) -> str:
+    segments = _worker_model.transcribe(pcm.astype(np.float32) / 32768.0, language="auto")
+    return "".join(segment.text for segment in segments)
+
+@functools.lru_cache(maxsize=4)
+def _scan_model_dir(model_dir: str, mtime_ns: int) -> Dict[str, str]:
+    """
+    扫描模型目录；以目录修改时间为缓存键，增删模型文件后自动失效
+    """
+    models = {}
+    try:
+        for file in os.listdir(model_dir):
+            if file.startswith("ggml-") and file.endswith(".bin"):
+                models[file[5:-4]] = os.path.join(model_dir, file)
+    except Exception as e:
+        logger.error(f"Error listing models: {e}")
+    return models
+
+def build_wav(pcm: np.ndarray, sample_rate: int = 16000) -> bytearray:
+    """
+    构造单声道 16 位 PCM 的 WAV 数据：手写 44 字节 RIFF 头，样本只拷贝一次
+    """
+    data_size = pcm.nbytes
+    wav = bytearray(44 + data_size)
+    struct.pack_into(
+        '<4sI4s4sIHHIIHH4sI', wav, 0,
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b'data', data_size
+    )
+    wav[44:] = memoryview(np.ascontiguousarray(pcm, dtype=np.int16)).cast("B")
+    return wav
+
+def find_split_points(pcm: np.ndarray, sample_rate: int = 16000, max_chunk_sec: float = 30,
+                      silence_db: float = -30, min_silence_sec: float = 0.5) -> list[Tuple[int, int]]:
+    """
+    按静音位置把音频切分为不超过 max_chunk_sec 的片段
+    返回: [(起始样本, 结束样本), ...]
+    """
+    total = pcm.size
+    max_len = int(max_chunk_sec * sample_rate)
+    if total <= max_len:
+        return [(0, total)]
+    
+    # 以 10ms 为帧计算能量，找出持续时间足够长的静音段，取其中点作为候选切分点
+    hop = sample_rate // 100
+    n_frames = total // hop
+    frames = pcm[:n_frames * hop].reshape(n_frames, hop).astype(np.float32)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    silent = 20 * np.log10(rms / 32768 + 1e-10) < silence_db
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    min_frames = int(min_silence_sec * 100)
+    long_runs = (run_ends - run_starts) >= min_frames
+    cuts = ((run_starts[long_runs] + run_ends[long_runs]) // 2) * hop
+    
+    # 贪心：在不超过最大长度的前提下选择最靠后的静音点；没有则强制切分
+    chunks = []
+    start = 0
+    while total - start > max_len:
+        limit = start + max_len
+        i = np.searchsorted(cuts, limit, side="right") - 1
+        end = int(cuts[i]) if i >= 0 and cuts[i] > start else limit
+        chunks.append((start, end))
+        start = end
+    chunks.append((start, total))
+    return chunks
+
+class WhisperServer:
+    """
+    常驻的 whisper.cpp server 进程：模型只加载一次，每次识别通过本地 HTTP 提交 WAV，
+    不再为每个请求 fork/exec 并重新加载模型
+    """
+    def __init__(self, server_path: str, model_path: str, threads: int, processors: int,
+                 startup_timeout: float = 30) -> None:
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self._process = subprocess.Popen(
+            [
+                server_path,
+                "-m", model_path,
+                "-t", str(threads),
+                "-p", str(processors),
+                "-l", "auto",     # 自动检测语言，server 默认按英文识别
+                "--host", "127.0.0.1",
+                "--port", str(self.port),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            start_new_session=True
+        )
+        
+        # 端口是先绑定再释放后交给子进程的，可能被其他进程抢占；
+        # 因此用一段静音实际请求 /inference，返回识别结果才说明模型已加载、对端确实是 whisper server
+        probe = build_wav(np.zeros(1600, dtype=np.int16))
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            if self._process.poll() is not None:
+                raise RuntimeError(f"whisper server 启动失败 (返回码: {self._process.returncode})")
+            try:
+                self.transcribe(probe, timeout=10)
+                break
+            except (OSError, http.client.HTTPException, RuntimeError, ValueError, KeyError, TypeError):
+                if time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError("whisper server 启动超时")
+                time.sleep(0.1)
+
+    def transcribe(self, wav_data: Union[bytes, bytearray], timeout: float = 300) -> str:
+        boundary = uuid.uuid4().hex
+        body = b"".join([
+            f"--{boundary}\r\n".encode(),
+            b'Content-Disposition: form-data; name="file"; filename="audio.wav"\r\n',
+            b"Content-Type: audio/wav\r\n\r\n",
+            wav_data,
+            f"\r\n--{boundary}\r\n".encode(),
+            b'Content-Disposition: form-data; name="response_format"\r\n\r\njson',
+            f"\r\n--{boundary}\r\n".encode(),
+            b'Content-Disposition: form-data; name="language"\r\n\r\nauto',
+            f"\r\n--{boundary}--\r\n".encode(),
+        ])
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=timeout)
+        try:
+            conn.request("POST", "/inference", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise RuntimeError(f"whisper server 返回错误 ({response.status}): {data.decode('utf-8', errors='replace')}")
+        return json.loads(data)["text"]
+
+    def is_alive(self) -> bool:
+        return self._process.poll() is None
+
+    def close(self) -> None:
+        if self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+
+class TranscriptionCache:
+    """
+    基于 SQLite 的识别结果缓存，以音频 PCM 内容、模型名和识别后端的哈希为键；
+    最多保留 max_entries 条，超出时按写入顺序淘汰最早的记录
+    """
+    def __init__(self, db_path: str, max_entries: int = 10000) -> None:
+        self._max_entries = max_entries
+        # 识别在线程池中执行，连接跨线程共享，用锁串行化访问
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache(k TEXT PRIMARY KEY, text TEXT)")
+
+    @staticmethod
+    def make_key(pcm_bytes: Union[bytes, memoryview], model_name: str, backend: str) -> str:
+        # 不同后端（faster-whisper / whisper.cpp）对同一音频的输出不同，后端也计入键
+        h = hashlib.blake2b(pcm_bytes)
+        h.update(model_name.encode())
+        h.update(b"\0" + backend.encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT text FROM cache WHERE k=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, text: str) -> None:
+        with self._lock, self._conn:
+            cur = self._conn.execute("INSERT OR IGNORE INTO cache(k, text) VALUES (?, ?)", (key, text))
+            if cur.rowcount:
+                # rowid 随写入递增，删除比最新记录早 max_entries 条以上的行，走主键范围查找
+                self._conn.execute(
+                    "DELETE FROM cache WHERE rowid <= (SELECT MAX(rowid) FROM cache) - ?",
+                    (self._max_entries,)
+                )
+
 class VoiceService:
-    def __init__(self) -> None:
+    def __init__(self, use_bindings: bool = True, default_model: str = "ggml-tiny.bin",
+                 lock_memory: bool = False, use_cache: bool = True, use_gpu: bool = True,
+                 use_server: bool = True) -> None:
         self._whisper_path = "/home/huiyu/whisper.cpp"
         self._output_dir = "outputs"
         self._model_dir = os.path.join(self._whisper_path, "models")
         os.makedirs(self._output_dir, exist_ok=True)
+        # 推理线程数按主机核数计算，留一个核给事件循环和录音
+        self._threads = max(1, (os.cpu_count() or 1) - 1)
+        # 核数足够时让 whisper.cpp 分段并行处理，每个处理器分到一半线程
+        self._processors = 2 if self._threads >= 8 else 1
+        
+        # 识别结果缓存，相同音频直接返回
+        self._cache: Optional[TranscriptionCache] = None
+        if use_cache:
+            self._cache = TranscriptionCache(os.path.join(self._output_dir, "transcription_cache.sqlite3"))
+        
+        # 有 CUDA 设备且安装了 faster-whisper 时使用 GPU INT8 推理，失败则回退到 whisper.cpp
+        self._use_gpu = use_gpu and FasterWhisperModel is not None
+        self._gpu_models: Dict[str, "FasterWhisperModel"] = {}
+        # faster-whisper 加载失败的模型（如没有对应的转换权重），只对这些模型回退到 whisper.cpp
+        self._failed_gpu_models: Set[str] = set()
+        if self._use_gpu:
+            try:
+                if ctranslate2.get_cuda_device_count() == 0:
+                    raise RuntimeError("未检测到 CUDA 设备")
+                self._get_gpu_model(default_model)
+            except Exception as e:
+                logger.info(f"GPU 推理不可用，使用 whisper.cpp: {e}")
+                self._use_gpu = False
+        
+        # 已安装 pywhispercpp 时在进程内推理，模型只加载一次；否则回退到命令行
+        self._use_bindings = use_bindings and WhisperModel is not None
+        self._models: Dict[str, "WhisperModel"] = {}
+        if self._use_bindings and not self._use_gpu:
+            try:
+                self._get_model(default_model)
+            except Exception as e:
+                logger.error(f"加载模型失败，回退到命令行模式: {e}")
+                self._use_bindings = False
+        
+        # 未安装绑定时优先使用常驻的 whisper.cpp server，按模型名缓存；启动失败则回退到命令行
+        self._use_server = use_server and os.path.exists(os.path.join(self._whisper_path, "server"))
+        self._servers: Dict[str, WhisperServer] = {}
+        # 启动失败的模型不再重试，只对该模型回退到命令行
+        self._failed_servers: Set[str] = set()
+        self._servers_lock = threading.Lock()
+        # 每个推理线程复用自己的 float32 缓冲区，避免每次转换都分配新数组
+        self._pcm_buffers = threading.local()
+        # 长音频并行识别用的进程池，按模型名缓存
+        self._parallel_pools: Dict[str, ProcessPoolExecutor] = {}
+        self._parallel_pools_lock = threading.Lock()
+        
+        # 环境噪音只校准一次并复用阈值；阈值漂移超过 20% 时由持有麦克风的线程在两句之间重新校准
+        self._mic_lock = threading.Lock()
+        # 录音结束后的识别步骤串行执行，录音本身不持有该锁
+        self._transcribe_lock = threading.Lock()
+        self._calibrated_threshold: Optional[float] = None
+        self._energy_threshold: Optional[float] = None
+        # 以下标志只在持有 _mic_lock 时读写
+        self._needs_recalibration = False
+        
+        # 模型加载后锁定已驻留的内存页，避免推理时因换出产生缺页
+        if lock_memory:
+            if self._models:
+                self._lock_resident_memory()
+            else:
+                # GPU、server 或命令行模式下本进程没有常驻的 whisper.cpp 模型，锁定内存没有意义
+                logger.warning("没有常驻内存的 whisper.cpp 模型，跳过锁定内存")
         
     def listen(self) -> tuple[str, float]:
         """
@@ -24,20 +322,11 @@ class VoiceService:
         """
         logger.info('Listening (mode: offline)...')
         try:
-            transcribed_file = f"{self._output_dir}/transcribed-audio.wav"
             r = sr.Recognizer()
             
-            with sr.Microphone(sample_rate=16000) as source:
-                # 配置语音识别参数
-                r.dynamic_energy_threshold = True    # 动态能量阈值
-                r.energy_threshold = 4000           # 音量阈值
-                r.pause_threshold = 0.8             # 停顿阈值，超过这个时间认为说完一句话
-                r.phrase_threshold = 0.3            # 短语阈值
-                r.non_speaking_duration = 0.4       # 非说话持续时间
-                
-                # 调整环境噪音
-                logger.info("正在调整环境噪音，请稍等...")
-                r.adjust_for_ambient_noise(source, duration=1)
+            with self._mic_lock, sr.Microphone(sample_rate=16000) as source:
+                self._configure_recognizer(r)
+                self._apply_energy_threshold(r, source)
                 
                 logger.info("开始录音，请说话...")
                 try:
@@ -56,231 +345,630 @@ class VoiceService:
                 except Exception as e:
                     logger.error(f"录音过程出错: {e}")
                     return f"录音错误: {str(e)}", 0
-            
-            try:
-                # 保存音频文件
-                with open(transcribed_file, "wb") as f:
-                    f.write(audio.get_wav_data())
                 
-                # 处理音频文件
-                start_time = time.time()
-                result = self.process_audio(transcribed_file)
-                duration = time.time() - start_time
-                
-                logger.info(f"处理完成，结果: {result}")
-                
-                # 清理临时文件
-                if os.path.exists(transcribed_file):
-                    os.remove(transcribed_file)
-                    
-                return result, duration
-                
-            except Exception as e:
-                logger.error(f"处理过程出错: {e}")
-                if os.path.exists(transcribed_file):
-                    os.remove(transcribed_file)
-                return f"处理错误: {str(e)}", 0
+                # 漂移过大时只做标记，下一次录音开始前再校准，不延迟本次识别
+                self._track_energy_threshold(r.energy_threshold)
+            
+            return self._transcribe_recording(audio)
                 
         except Exception as e:
             logger.error(f"语音识别过程出错: {e}")
             return f"识别错误: {str(e)}", 0
+
+    def listen_continuous(self, max_pending: int = 2) -> Iterator[Tuple[str, float]]:
+        """
+        连续录音并识别：后台线程独占麦克风持续录音，每段录音交给识别线程，
+        识别完成后立即产出，不必等下一句录完
+        仅作为库接口使用，HTTP 服务未提供对应的接口
+        参数:
+            max_pending: 最多同时等待识别的录音段数，超过时录音线程暂停
+        返回: 按录音顺序产出 (转录文本, 处理时长)
+        """
+        logger.info('Listening continuously (mode: offline)...')
+        results: "queue.Queue[Optional[Future]]" = queue.Queue()
+        stop = threading.Event()
+        slots = threading.BoundedSemaphore(max_pending)
+        executor = ThreadPoolExecutor(max_workers=1)
+        capture = threading.Thread(
+            target=self._capture_phrases, args=(executor, results, stop, slots), daemon=True
+        )
+        capture.start()
+        try:
+            while True:
+                future = results.get()
+                if future is None:
+                    # 录音线程已退出
+                    return
+                try:
+                    yield future.result()
+                finally:
+                    slots.release()
+        finally:
+            stop.set()
+            capture.join()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _capture_phrases(self, executor: ThreadPoolExecutor, results: "queue.Queue[Optional[Future]]",
+                         stop: threading.Event, slots: threading.BoundedSemaphore) -> None:
+        """
+        listen_continuous 的录音线程：持有 _mic_lock 逐句录音并提交识别，结束时放入 None
+        """
+        r = sr.Recognizer()
+        try:
+            with self._mic_lock, sr.Microphone(sample_rate=16000) as source:
+                self._configure_recognizer(r)
+                self._apply_energy_threshold(r, source)
+                
+                logger.info("开始录音，请说话...")
+                while not stop.is_set():
+                    try:
+                        # 等待开口的超时设短一些，以便及时响应停止请求
+                        audio = r.listen(source, timeout=1, phrase_time_limit=None)
+                    except sr.WaitTimeoutError:
+                        continue
+                    logger.info("录音完成，开始处理...")
+                    self._track_energy_threshold(r.energy_threshold)
+                    
+                    # 积压过多时暂停录音，等待调用方取走结果
+                    while not slots.acquire(timeout=0.5):
+                        if stop.is_set():
+                            return
+                    results.put(executor.submit(self._transcribe_recording, audio))
+                    
+                    # 两句之间在本线程重新校准，识别线程同时在后台处理上一句
+                    if self._needs_recalibration:
+                        self._apply_energy_threshold(r, source)
+        except Exception as e:
+            logger.error(f"连续录音出错: {e}")
+        finally:
+            results.put(None)
+
+    @staticmethod
+    def _configure_recognizer(r: sr.Recognizer) -> None:
+        # 配置语音识别参数
+        r.dynamic_energy_threshold = True    # 动态能量阈值
+        r.energy_threshold = 4000           # 音量阈值
+        r.pause_threshold = 0.8             # 停顿阈值，超过这个时间认为说完一句话
+        r.phrase_threshold = 0.3            # 短语阈值
+        r.non_speaking_duration = 0.4       # 非说话持续时间
+
+    def _apply_energy_threshold(self, r: sr.Recognizer, source: sr.Microphone) -> None:
+        """
+        使用缓存的能量阈值；首次使用或阈值漂移后校准环境噪音，结果直接作用于传入的识别器
+        （调用方需持有 _mic_lock）
+        """
+        if self._energy_threshold is None or self._needs_recalibration:
+            logger.info("正在调整环境噪音，请稍等...")
+            r.adjust_for_ambient_noise(source, duration=1)
+            self._calibrated_threshold = self._energy_threshold = r.energy_threshold
+            self._needs_recalibration = False
+            logger.info(f"环境噪音校准完成，阈值: {r.energy_threshold:.1f}")
+        else:
+            r.energy_threshold = self._energy_threshold
+
+    def _track_energy_threshold(self, threshold: float) -> None:
+        """
+        记录录音后动态调整的阈值；与校准值偏差超过 20% 时标记为需要重新校准，
+        由持有麦克风的线程在下一句开始前完成（调用方需持有 _mic_lock）
+        """
+        self._energy_threshold = threshold
+        baseline = self._calibrated_threshold
+        if baseline and abs(threshold - baseline) / baseline > 0.2:
+            self._needs_recalibration = True
+
+    def _transcribe_recording(self, audio: sr.AudioData) -> Tuple[str, float]:
+        """
+        识别一段录音
+        返回: (转录文本, 处理时长)
+        """
+        try:
+            # 直接取 16kHz/16 位 PCM 数据在内存中识别，不写临时 WAV 文件
+            pcm = np.frombuffer(audio.get_raw_data(convert_rate=16000, convert_width=2), dtype=np.int16)
+            
+            with self._transcribe_lock:
+                start_time = time.time()
+                result = self.process_audio(pcm)
+                duration = time.time() - start_time
+            
+            logger.info(f"处理完成，结果: {result}")
+            return result, duration
+            
+        except Exception as e:
+            logger.error(f"处理过程出错: {e}")
+            return f"处理错误: {str(e)}", 0
         
-    def process_audio(self, wav_file: str, model_name: str = "ggml-tiny.bin") -> str:
+    def process_audio(self, audio: Union[str, np.ndarray], model_name: str = "ggml-tiny.bin") -> str:
         """
-        处理音频文件
+        处理音频
         参数:
-            wav_file: WAV文件路径
+            audio: WAV文件路径，或 16kHz 单声道 int16 PCM 数组
             model_name: 模型文件名（默认使用 tiny 模型）
         返回:
             识别的文本
         """
         try:
-            # 1. 检查音频文件
-            if not os.path.exists(wav_file):
-                raise FileNotFoundError(f"音频文件不存在: {wav_file}")
-                
-            # 2. 检查音频格式
-            try:
-                import wave
-                with wave.open(wav_file, 'rb') as wf:
-                    print(f"音频文件信息:")
-                    print(f"- 声数: {wf.getnchannels()}")
-                    print(f"- 采样宽度: {wf.getsampwidth()}")
-                    print(f"- 采样率: {wf.getframerate()}")
-                    print(f"- 总帧数: {wf.getnframes()}")
-                    print(f"- 参数: {wf.getparams()}")
-
-                    # 检查采样率
-                    if wf.getframerate() != 16000:
-                        raise ValueError(f"音频采样率必须是16kHz，当前是{wf.getframerate()}Hz")
-            except Exception as e:
-                print(f"音频文件检查错误: {e}")
+            # 1. 获取 PCM 数据：数组格式已知，文件则读取 WAV
+            if isinstance(audio, str):
+                pcm = self._read_wav_pcm(audio)
+            else:
+                pcm = np.ascontiguousarray(audio, dtype=np.int16)
 
-            # 3. 检查模型文件
-            model_path = os.path.join(self._whisper_path, "models", model_name)
-            if not os.path.exists(model_path):
-                raise FileNotFoundError(f"模型文件不存在: {model_path}")
-                
-            print(f"使用模型: {model_path}")
+            # 2. 检查模型文件
+            model_path = self._model_path(model_name)
                 
-            # 4. 构建命令 - 只用支持的参数
-            command = [
-                os.path.join(self._whisper_path, "main"),
-                "-m", model_path,
-                "-f", wav_file,
-                "-l", "auto",     # 自动检测语言
-                "-np",           # 不显示进度条
-                "-nt",          # 不显示时间戳
-                "--max-len", "0"  # 不限制输出长度
-            ]
-                
-            print(f"执行命令: {' '.join(command)}")
-                
-            # 5. 执行命令
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-                
-            # 6. 获取输出
-            stdout, stderr = process.communicate()
-                
-            print(f"标准输出: {stdout}")
-            if stderr:
-                print(f"标准错误: {stderr}")
+            logger.debug(f"使用模型: {model_path}")
+            
+            # 3. 查询缓存：相同音频、模型和后端直接返回之前的结果
+            backend = self._select_backend(model_name)
+            preferred_backend = backend
+            cache_key = None
+            if self._cache is not None:
+                cache_key = TranscriptionCache.make_key(memoryview(pcm).cast("B"), model_name, backend)
+                cached = self._cache.get(cache_key)
+                if cached is not None:
+                    logger.debug(f"命中识别缓存: {cached}")
+                    return cached
                 
-            # 7. 检查返回码
-            if process.returncode != 0:
-                error_msg = f"Whisper处理失败 (返回码: {process.returncode}): {stderr}"
-                print(error_msg)
-                raise RuntimeError(error_msg)
+            # 4. 识别：优先使用 GPU，其次常驻模型或 server 进程，否则调用命令行
+            text = None
+            if backend == "gpu":
+                try:
+                    self._get_gpu_model(model_name)
+                except Exception as e:
+                    logger.error(f"加载 GPU 模型失败，该模型回退到 whisper.cpp: {e}")
+                    self._failed_gpu_models.add(model_name)
+                    backend = self._select_backend(model_name)
+                else:
+                    text = self._transcribe_with_gpu(pcm, model_name)
+            if backend == "bindings":
+                text = self._transcribe_with_bindings(pcm, model_name)
+            elif backend == "server" and (server := self._get_server(model_name, model_path)) is not None:
+                try:
+                    text = server.transcribe(build_wav(pcm))
+                except (OSError, http.client.HTTPException) as e:
+                    logger.error(f"whisper server 请求失败，回退到命令行模式: {e}")
+                    self._evict_server(model_name, server)
+            if text is None:
+                backend = "cli"
+                text = self._transcribe_with_cli(pcm, model_path)
                 
-            # 8. 处理输出文本
-            text = stdout.strip()
+            # 5. 处理输出文本
+            text = text.strip()
                 
-            # 9. 特���情况处理
+            # 6. 特殊情况处理
             if not text:
-                print("没有检测到文本")
-                return "未检测到语音内容"
-                
-            if text == '[BLANK_AUDIO]':
-                print("检测到空白音频")
-                return "检测到空白音频"
-                
-            # 10. 清理并返回结果
-            result = text.replace('[BLANK_AUDIO]', '').strip()
-            print(f"最终识别结果: {result}")
+                logger.debug("没有检测到文本")
+                result = "未检测到语音内容"
+            elif text == '[BLANK_AUDIO]':
+                logger.debug("检测到空白音频")
+                result = "检测到空白音频"
+            else:
+                # 7. 清理结果
+                result = text.replace('[BLANK_AUDIO]', '').strip()
+                logger.debug(f"最终识别结果: {result}")
+            
+            # 8. 写入缓存并返回；回退到命令行时按实际使用的后端写入
+            if cache_key is not None:
+                if backend != preferred_backend:
+                    cache_key = TranscriptionCache.make_key(memoryview(pcm).cast("B"), model_name, backend)
+                self._cache.put(cache_key, result)
                 
             return result
                 
         except Exception as e:
-            print(f"处理音频时发生错误: {str(e)}")
+            logger.error(f"处理音频时发生错误: {str(e)}")
             raise RuntimeError(f"音频处理失败: {str(e)}")
 
+    def process_audio_parallel(self, audio: Union[str, np.ndarray], model_name: str = "ggml-tiny.bin",
+                               max_chunk_sec: float = 30) -> list[str]:
+        """
+        长音频并行识别：按静音切分后分发到多个进程，再按时间顺序合并
+        参数:
+            audio: WAV文件路径，或 16kHz 单声道 int16 PCM 数组
+            model_name: 模型文件名
+            max_chunk_sec: 每个片段的最大时长（秒）
+        返回: 句子列表
+        """
+        pcm = self._read_wav_pcm(audio) if isinstance(audio, str) else np.ascontiguousarray(audio, dtype=np.int16)
+        if pcm.size == 0:
+            return []
+        
+        if self._select_backend(model_name) != "bindings":
+            # GPU、server 和命令行模式整段识别，不在本进程另外加载 CPU 常驻模型
+            return list(self._clean_whisper_output(self.process_audio(pcm, model_name)))
+        
+        chunks = find_split_points(pcm, 16000, max_chunk_sec)
+        logger.info(f"并行识别: {len(chunks)} 个片段")
+        
+        if len(chunks) == 1:
+            # 常驻模型的上下文不是线程安全的，与录音识别共用 _transcribe_lock
+            with self._transcribe_lock:
+                text = self.process_audio(pcm, model_name)
+        else:
+            pool = self._get_parallel_pool(model_name)
+            texts = pool.map(_transcribe_chunk, [pcm[start:end] for start, end in chunks])
+            text = " ".join(texts)
+        return list(self._clean_whisper_output(text))
+
+    def _select_backend(self, model_name: str) -> str:
+        """
+        按 GPU、常驻模型、server 进程、命令行的顺序选择该模型可用的识别后端
+        """
+        if self._use_gpu and model_name not in self._failed_gpu_models:
+            return "gpu"
+        if self._use_bindings:
+            return "bindings"
+        if self._use_server and model_name not in self._failed_servers:
+            return "server"
+        return "cli"
+
+    def _get_parallel_pool(self, model_name: str) -> ProcessPoolExecutor:
+        """
+        获取并行识别进程池，每个工作进程在启动时加载一次模型
+        """
+        with self._parallel_pools_lock:
+            pool = self._parallel_pools.get(model_name)
+            if pool is None:
+                cpu_count = os.cpu_count() or 1
+                workers = max(1, cpu_count // 4)
+                pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    # 服务进程中已有其他线程，使用 spawn 避免 fork 带来的锁状态问题
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_parallel_worker,
+                    initargs=(self._model_path(model_name), max(1, cpu_count // workers)),
+                )
+                self._parallel_pools[model_name] = pool
+            return pool
+
+    def _get_server(self, model_name: str, model_path: str) -> Optional[WhisperServer]:
+        """
+        获取该模型的 whisper.cpp server，首次使用时启动；不可用时返回 None
+        """
+        if not self._use_server or model_name in self._failed_servers:
+            return None
+        with self._servers_lock:
+            server = self._servers.get(model_name)
+            if server is not None and not server.is_alive():
+                logger.warning(f"whisper server 已退出，重新启动: {model_path}")
+                self._servers.pop(model_name)
+                server = None
+            if server is None:
+                try:
+                    logger.info(f"启动 whisper server: {model_path}")
+                    server = WhisperServer(
+                        os.path.join(self._whisper_path, "server"),
+                        model_path,
+                        self._threads // self._processors,
+                        self._processors
+                    )
+                except Exception as e:
+                    logger.error(f"whisper server 不可用，该模型回退到命令行模式: {e}")
+                    self._failed_servers.add(model_name)
+                    return None
+                self._servers[model_name] = server
+            return server
+
+    def _evict_server(self, model_name: str, server: WhisperServer) -> None:
+        """
+        移除请求失败的 server，下次使用时重新启动
+        """
+        with self._servers_lock:
+            if self._servers.get(model_name) is server:
+                del self._servers[model_name]
+        server.close()
+
+    def shutdown(self) -> None:
+        """
+        关闭并行识别进程池和 whisper server 进程
+        """
+        with self._parallel_pools_lock:
+            for pool in self._parallel_pools.values():
+                pool.shutdown(wait=False, cancel_futures=True)
+            self._parallel_pools.clear()
+        with self._servers_lock:
+            for server in self._servers.values():
+                server.close()
+            self._servers.clear()
+
+    def _get_model(self, model_name: str) -> "WhisperModel":
+        """
+        获取已加载的模型，首次使用时加载并缓存
+        """
+        model = self._models.get(model_name)
+        if model is None:
+            model_path = self._model_path(model_name)
+            logger.info(f"加载模型: {model_path}")
+            model = WhisperModel(
+                model_path,
+                n_threads=self._threads,
+                print_progress=False,
+                print_realtime=False,
+            )
+            self._models[model_name] = model
+        return model
+
+    def _pcm_to_float32(self, pcm: np.ndarray) -> np.ndarray:
+        """
+        把 int16 PCM 转为 [-1, 1) 的 float32，写入当前线程预分配的缓冲区（默认 30 秒，不足时扩容）
+        返回的是缓冲区视图，只在本次推理期间有效
+        """
+        buffer = getattr(self._pcm_buffers, "f32", None)
+        if buffer is None or buffer.size < pcm.size:
+            buffer = np.empty(max(16000 * 30, pcm.size), dtype=np.float32)
+            self._pcm_buffers.f32 = buffer
+        out = buffer[:pcm.size]
+        np.multiply(pcm, np.float32(1.0 / 32768.0), out=out)
+        return out
+
+    def _get_gpu_model(self, model_name: str) -> "FasterWhisperModel":
+        """
+        获取 GPU 模型，首次使用时加载；ggml-<size>.bin 映射为 faster-whisper 的 <size>
+        """
+        model = self._gpu_models.get(model_name)
+        if model is None:
+            size = model_name.removeprefix("ggml-").removesuffix(".bin")
+            logger.info(f"加载 GPU 模型: {size}")
+            model = FasterWhisperModel(size, device="cuda", compute_type="int8_float16")
+            self._gpu_models[model_name] = model
+        return model
+
+    def _transcribe_with_gpu(self, pcm: np.ndarray, model_name: str) -> str:
+        """
+        使用 faster-whisper 在 GPU 上识别 16kHz 单声道 int16 PCM 数据
+        """
+        segments, _ = self._get_gpu_model(model_name).transcribe(
+            self._pcm_to_float32(pcm),
+            language=None,
+            beam_size=1,
+            vad_filter=True
+        )
+        return " ".join(segment.text.strip() for segment in segments)
+
+    @staticmethod
+    def _lock_resident_memory() -> None:
+        """
+        使用 mlockall(MCL_CURRENT) 锁定当前已映射的内存（包括已加载的模型权重）
+        需要足够的 RLIMIT_MEMLOCK，失败时只记录警告
+        """
+        if not sys.platform.startswith("linux"):
+            logger.warning("仅 Linux 支持锁定模型内存")
+            return
+        MCL_CURRENT = 1
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.mlockall(MCL_CURRENT) != 0:
+            errno = ctypes.get_errno()
+            logger.warning(f"锁定模型内存失败: {os.strerror(errno)}")
+        else:
+            logger.info("已锁定模型内存")
+
+    @staticmethod
+    def _read_wav_pcm(wav_file: str) -> np.ndarray:
+        """
+        读取 16kHz 单声道 16 位 WAV 文件的 PCM 数据
+        """
+        try:
+            wf = wave.open(wav_file, 'rb')
+        except FileNotFoundError:
+            raise FileNotFoundError(f"音频文件不存在: {wav_file}")
+        with wf:
+            if wf.getframerate() != 16000 or wf.getnchannels() != 1 or wf.getsampwidth() != 2:
+                raise ValueError(f"音频必须是16kHz单声道16位，当前参数: {wf.getparams()}")
+            return np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+
+    def _transcribe_with_bindings(self, pcm: np.ndarray, model_name: str) -> str:
+        """
+        使用常驻内存的模型识别 16kHz 单声道 int16 PCM 数据
+        """
+        segments = self._get_model(model_name).transcribe(
+            self._pcm_to_float32(pcm),
+            language="auto"
+        )
+        return "".join(segment.text for segment in segments)
+
+    def _transcribe_with_cli(self, pcm: np.ndarray, model_path: str) -> str:
+        """
+        调用 whisper.cpp 命令行识别（未安装 pywhispercpp 时的回退路径）
+        WAV 数据通过 stdin 传入，不写临时文件
+        """
+        # 构建命令 - 只用支持的参数
+        command = [
+            os.path.join(self._whisper_path, "main"),
+            "-m", model_path,
+            "-f", "-",        # 从 stdin 读取 WAV
+            "-l", "auto",     # 自动检测语言
+            "-t", str(self._threads // self._processors),  # 每个处理器的线程数
+            "-p", str(self._processors),                   # 处理器数
+            "-np",           # 不显示进度条
+            "-nt",          # 不显示时间戳
+            "--max-len", "0"  # 不限制输出长度
+        ]
+            
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"执行命令: {' '.join(command)}")
+        
+        # 在内存中构造 WAV
+        wav_data = build_wav(pcm)
+            
+        # 执行命令
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+            
+        # 获取输出
+        stdout, stderr = process.communicate(wav_data)
+        stdout = stdout.decode("utf-8", errors="replace")
+        stderr = stderr.decode("utf-8", errors="replace")
+            
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"标准输出: {stdout}")
+            if stderr:
+                logger.debug(f"标准错误: {stderr}")
+            
+        # 检查返回码
+        if process.returncode != 0:
+            error_msg = f"Whisper处理失败 (返回码: {process.returncode}): {stderr}"
+            logger.error(error_msg)
+            raise RuntimeError(error_msg)
+            
+        return stdout
+
     def get_available_models(self) -> Dict[str, str]:
         """
-        获取可用的模型列表
+        获取可用的模型列表（按目录修改时间缓存，目录不变时不重新扫描）
         返回: 模型名称和路径的字典
         """
-        models = {}
         try:
-            for file in os.listdir(self._model_dir):
-                if file.startswith("ggml-") and file.endswith(".bin"):
-                    model_name = file.replace("ggml-", "").replace(".bin", "")
-                    models[model_name] = os.path.join(self._model_dir, file)
-        except Exception as e:
+            mtime_ns = os.stat(self._model_dir).st_mtime_ns
+        except OSError as e:
             logger.error(f"Error listing models: {e}")
-        return models
+            return {}
+        return _scan_model_dir(self._model_dir, mtime_ns)
+
+    def refresh_models(self) -> Dict[str, str]:
+        """
+        清空缓存并重新扫描模型目录
+        """
+        _scan_model_dir.cache_clear()
+        return self.get_available_models()
+
+    def _model_path(self, model_name: str) -> str:
+        """
+        查找模型文件路径，与 get_available_models 共用按目录修改时间缓存的扫描结果；
+        未命中时不会重新扫描目录，客户端无法通过请求不存在的模型触发 listdir
+        """
+        model_path = None
+        if model_name.startswith("ggml-") and model_name.endswith(".bin"):
+            model_path = self.get_available_models().get(model_name[5:-4])
+        if model_path is None:
+            raise FileNotFoundError(f"模型文件不存在: {os.path.join(self._model_dir, model_name)}")
+        return model_path
 
     def check_model_exists(self, model_name: str) -> bool:
         """
-        检查指定模型是否存在
+        检查指定模型是否存在，接受模型名（tiny）或模型文件名（ggml-tiny.bin）
+        """
+        models = self.get_available_models()
+        if model_name.startswith("ggml-") and model_name.endswith(".bin"):
+            model_name = model_name[5:-4]
+        return model_name in models
+
+    def process_stream(self, audio_file: str, model_name: str = "ggml-tiny.bin") -> Iterator[str]:
+        """
+        识别 RAW 音频文件（HTTP 上传路径使用）
+        返回: 句子迭代器，whisper 每输出一行就产出其中的新句子
         """
-        model_path = os.path.join(self._model_dir, f"ggml-{model_name}.bin")
-        return os.path.exists(model_path)
+        return self._run_stream(audio_file, model_name)
 
-    def process_stream(self, audio_file: str, model_name: str = "ggml-tiny.bin") -> list[str]:
+    def process_stream_array(self, pcm_int16: np.ndarray, sample_rate: int = 16000,
+                             model_name: str = "ggml-tiny.bin") -> Iterator[str]:
+        """
+        直接识别内存中的 int16 PCM 数据，不经过临时文件
+        参数:
+            pcm_int16: 单声道 int16 PCM 样本
+            sample_rate: 采样率
+            model_name: 模型文件名
+        返回: 句子迭代器
+        """
+        pcm = np.ascontiguousarray(pcm_int16, dtype=np.int16)
+        # 通过 stdin 传给 whisper，memoryview 避免额外拷贝
+        return self._run_stream("-", model_name, sample_rate, memoryview(pcm).cast("B"))
+
+    def _run_stream(self, audio_file: str, model_name: str, sample_rate: int = 16000,
+                    pcm_input: Optional[memoryview] = None) -> Iterator[str]:
+        # 直接使用 RAW 文件，"-" 表示从 stdin 读取
+        cmd = [
+            os.path.join(self._whisper_path, "stream"),
+            "-m", self._model_path(model_name),
+            "-f", audio_file,     # 直接使用原始音频文件
+            "-t", str(self._threads),  # 按主机核数设置线程数
+            "--step", "500",      # 步长500ms
+            "--length", "5000",   # 处理窗口5000ms
+            "-nr",                # 指定为 RAW 格式
+            "-sr", str(sample_rate),  # 采样率
+            "-ch", "1",           # 单声道
+            "-bd", "16",          # 16位深度
+        ]
+        
+        logger.info(f"执行命令: {' '.join(cmd)}")
+        
         try:
-            # 直接使用 RAW 文件
-            cmd = [
-                os.path.join(self._whisper_path, "stream"),
-                "-m", os.path.join(self._model_dir, model_name),
-                "-f", audio_file,     # 直接使用原始音频文件
-                "-t", "8",            # 8线程
-                "--step", "500",      # 步长500ms
-                "--length", "5000",   # 处理窗口5000ms
-                "-nr",                # 指定为 RAW 格式
-                "-sr", "16000",       # 采样率
-                "-ch", "1",           # 单声道
-                "-bd", "16",          # 16位深度
-            ]
-            
-            logger.info(f"执行命令: {' '.join(cmd)}")
-            
-            # 运行命令
-            process = subprocess.run(
+            # 二进制模式启动，便于通过 stdin 传入 PCM，并逐行读取 stdout
+            process = subprocess.Popen(
                 cmd,
+                stdin=subprocess.PIPE if pcm_input is not None else subprocess.DEVNULL,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                universal_newlines=True,
-                check=True,
                 cwd=self._whisper_path
             )
-            
-            # 检查输出
-            if process.stderr:
-                logger.info(f"whisper stderr输出: {process.stderr}")
-            
-            result = process.stdout.strip()
-            logger.info(f"whisper 原始输出: {result}")
-            
-            return self._clean_whisper_output(result)
-            
-        except subprocess.CalledProcessError as e:
-            logger.error(f"whisper 命令行错误: {e.stderr}")
-            raise RuntimeError(f"Whisper处理失败: {e.stderr}")
         except Exception as e:
             logger.error(f"处理错误: {e}")
             raise RuntimeError(f"音频处理失败: {str(e)}")
+        
+        # stdin 写入和 stderr 读取放在后台线程，避免管道写满导致死锁
+        stderr_chunks: list[bytes] = []
+        workers = [threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)]
+        if pcm_input is not None:
+            def feed_stdin() -> None:
+                try:
+                    process.stdin.write(pcm_input)
+                except BrokenPipeError:
+                    pass
+                finally:
+                    process.stdin.close()
+            workers.append(threading.Thread(target=feed_stdin, daemon=True))
+        for worker in workers:
+            worker.start()
+        
+        try:
+            # 每读到一行就清理并产出新句子，调用方无需等待整段音频处理完
+            seen = set()
+            for raw_line in process.stdout:
+                line = raw_line.decode("utf-8", errors="replace")
+                yield from self._clean_whisper_output(line, seen)
+            
+            returncode = process.wait()
+            for worker in workers:
+                worker.join()
+            stderr = b"".join(stderr_chunks).decode("utf-8", errors="replace")
+            
+            # 检查输出
+            if stderr:
+                logger.info(f"whisper stderr输出: {stderr}")
+            if returncode != 0:
+                logger.error(f"whisper 命令行错误: {stderr}")
+                raise RuntimeError(f"Whisper处理失败: {stderr}")
+        finally:
+            # 调用方提前停止迭代时结束子进程
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
 
-    def _clean_whisper_output(self, text: str) -> list[str]:
+    def _clean_whisper_output(self, text: str, seen: Optional[set] = None) -> Iterator[str]:
         """
         清理 whisper.cpp 输出中的特殊标记，并按句子分割
-        返回: 句子列表
+        参数:
+            seen: 已产出的句子集合；流式处理多行输出时传入同一个集合以跨行去重
+        返回: 句子迭代器，按出现顺序逐个产出不重复的句子
         """
-        logger.info(f"清理前的文本: {text}")
-        
-        # 移除 ANSI 转义序列
-        text = re.sub(r'\x1b\[[0-9;]*[a-zA-Z]', '', text)
-        
-        # 移除所有特殊标记
-        text = re.sub(r'\[.*?\]', '', text)
-        
-        # 移除多余的空白行
-        text = re.sub(r'\n\s*\n', '\n', text)
-        
-        # 移除开头和结尾的空白
-        text = text.strip()
-        
-        # 移除每行开头和结尾的空白
-        lines = [line.strip() for line in text.split('\n')]
-        text = ' '.join(line for line in lines if line)
-        
-        logger.info(f"清理后的文本: {text}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"清理前的文本: {text}")
         
-        # 按句子分割（使用句号、问号、感叹号作为分隔符）
-        sentences = re.split(r'[.。!！?？]+', text)
+        # 一次扫描同时移除 ANSI 转义序列和所有特殊标记
+        text = _MARKUP_RE.sub('', text)
         
-        # 清理每个句子并过滤掉空句子和重复句子
-        seen = set()
-        cleaned_sentences = []
-        for s in sentences:
-            s = s.strip()
-            if s and s not in seen:
-                cleaned_sentences.append(s)
-                seen.add(s)
+        # 去掉空行和每行首尾的空白，合并为一行
+        text = ' '.join(line for line in (raw.strip() for raw in text.split('\n')) if line)
         
-        logger.info(f"最终句子列表: {cleaned_sentences}")
-        return cleaned_sentences
\ No newline at end of file
+        # 按句子分割（使用句号、问号、感叹号作为分隔符），过滤空句子和重复句子
+        if seen is None:
+            seen = set()
+        for match in _SENTENCE_RE.finditer(text):
+            sentence = match.group().strip()
+            if sentence and sentence not in seen:
+                seen.add(sentence)
+                yield sentence